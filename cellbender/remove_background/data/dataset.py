@@ -6,17 +6,13 @@ import scipy.sparse as sp
 import scipy.io as io
 import cellbender.remove_background.model
 import cellbender.remove_background.data.transform as trans
-from sklearn.decomposition import PCA
 import torch
-from scipy.stats import mode
 
 from typing import Dict, List, Union, Tuple
 import logging
+import math
 import os
-
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt  # This needs to be after matplotlib.use('Agg')
+import weakref
 
 
 class Dataset:
@@ -73,6 +69,10 @@ class Dataset:
         self.transformation = transformation
         self.low_count_threshold = low_count_threshold
         self.priors = {'n_cells': expected_cell_count}
+        self._analyzed_matrix_cache = None  # Kept only while estimating priors
+        self._trimmed_matrix_cache = None  # Memoized get_count_matrix()
+        self._trimmed_empties_cache = None  # Memoized get_count_matrix_empties()
+        self._umi_counts_cache = (None, None)  # (weakref to matrix, UMI counts)
 
         # Load the dataset.
         self._load_data()
@@ -114,6 +114,41 @@ class Dataset:
         else:
             self.data = get_matrix_from_h5(self.input_file)
 
+    def _get_umi_counts(self) -> np.ndarray:
+        """Get total UMI counts per barcode of the full count matrix.
+
+        This is computed once per count matrix, as it is needed both to
+        estimate the cell count and to trim the dataset.
+
+        """
+
+        # The matrix is referenced weakly, so that a replaced count matrix
+        # is not kept alive by this cache.
+        matrix = self.data['matrix']
+        matrix_ref, umi_counts = self._umi_counts_cache
+        if matrix_ref is None or matrix_ref() is not matrix:
+            umi_counts = _csr_row_sums(matrix)
+            self._umi_counts_cache = (weakref.ref(matrix), umi_counts)
+
+        return umi_counts
+
+    def _get_analyzed_matrix(self) -> sp.csr_matrix:
+        """Get the untransformed count matrix of all barcodes, analyzed genes.
+
+        While priors are being estimated, the columns for
+        self.analyzed_gene_inds are selected only once, and the result is
+        re-used by each estimator.  Otherwise the matrix is built on demand,
+        since it is about as large as the full count matrix.
+
+        """
+
+        if self._analyzed_matrix_cache is not None:
+            return self._analyzed_matrix_cache
+
+        return _csr_submatrix(self.data['matrix'],
+                              rows=slice(None),
+                              cols=self.analyzed_gene_inds)
+
     def _trim_dataset_for_analysis(self,
                                    low_UMI_count_cutoff: int = 30,
                                    num_transition_barcodes: Union[int, None] = 7000,
@@ -144,37 +179,49 @@ class Dataset:
 
         logging.info("Trimming dataset for inference.")
 
-        # Get data matrix and barcode order that sorts barcodes by UMI count.
+        # Any previously trimmed matrices are invalidated by re-trimming.
+        self._analyzed_matrix_cache = None
+        self._trimmed_matrix_cache = None
+        self._trimmed_empties_cache = None
+
+        # Get data matrix and UMI counts per barcode.
         matrix = self.data['matrix']
-        umi_counts = np.array(matrix.sum(axis=1)).squeeze()
-        umi_count_order = np.argsort(umi_counts)[::-1]
+        umi_counts = self._get_umi_counts()
+
+        # Barcode indices are stored as int32.
+        assert matrix.shape[0] < 2**31, "Too many barcodes to index as int32."
 
         # Initially set the default to be the whole dataset.
         self.analyzed_barcode_inds = np.arange(start=0, stop=matrix.shape[0])
         self.analyzed_gene_inds = np.arange(start=0, stop=matrix.shape[1])
 
         # Expected cells must not exceed nonzero count barcodes.
-        num_nonzero_barcodes = np.sum(umi_counts > 0).item()
+        num_nonzero_barcodes = np.count_nonzero(umi_counts)
         n_cells = min(self.priors['n_cells'], num_nonzero_barcodes)
 
         try:
 
             # Choose which genes to use based on their having nonzero counts.
             # (All barcodes must be included so that inference can generalize.)
-            gene_counts_per_barcode = np.array(matrix.sum(axis=0)).squeeze()
-            self.analyzed_gene_inds = np.where(gene_counts_per_barcode
-                                               > 0)[0].astype(dtype=int)
+            gene_counts_per_barcode = _csr_col_sums(matrix)
+            keep = gene_counts_per_barcode > 0
 
             if len(gene_blacklist) > 0:
 
                 # Ensure genes on the blacklist are excluded.
-                self.analyzed_gene_inds = np.array([g for g in
-                                                    self.analyzed_gene_inds
-                                                    if g not in gene_blacklist])
+                blacklist = np.asarray(gene_blacklist, dtype=int)
+                blacklist = blacklist[(blacklist >= 0)
+                                      & (blacklist < keep.size)]
+                keep[blacklist] = False
+
+            self.analyzed_gene_inds = np.flatnonzero(keep).astype(dtype=np.int32)
 
         except IndexError:
             logging.warning("Something went wrong trying to trim genes.")
 
+        # Keep the analyzed-gene matrix until priors have been estimated.
+        self._analyzed_matrix_cache = self._get_analyzed_matrix()
+
         # Estimate priors on cell size and 'empty' droplet size.
         self.priors['cell_counts'], self.priors['empty_counts'] = \
             get_d_priors_from_dataset(self)  # After gene trimming
@@ -182,17 +229,17 @@ class Dataset:
         # If running the simple model, just use the expected cells, no more.
         if self.model_name == "simple":
 
+            # Barcode order that sorts the top barcodes by UMI count.
+            umi_count_order = _top_k_order(umi_counts, n_cells)
+
             self.analyzed_barcode_inds = np.array(umi_count_order[:n_cells],
-                                                  dtype=int)
+                                                  dtype=np.int32)
 
         # If not using the simple model, include empty droplets.
         else:
 
             try:
 
-                # Get the cell barcodes.
-                cell_barcodes = umi_count_order[:n_cells]
-
                 # Set the low UMI count cutoff to be the greater of either
                 # the user input value, or an empirically-derived value.
                 empirical_low_UMI = int(self.priors['empty_counts'] * 0.8)
@@ -203,7 +250,16 @@ class Dataset:
 
                 # See how many barcodes there are to work with total.
                 num_barcodes_above_umi_cutoff = \
-                    np.sum(umi_counts > low_UMI_count_cutoff).item()
+                    np.count_nonzero(umi_counts > low_UMI_count_cutoff)
+
+                # Barcode order that sorts barcodes by UMI count.  Only the
+                # barcodes that can be analyzed need to be put in order.
+                umi_count_order = \
+                    _top_k_order(umi_counts, max(n_cells,
+                                                 num_barcodes_above_umi_cutoff))
+
+                # Get the cell barcodes.
+                cell_barcodes = umi_count_order[:n_cells]
 
                 # Get a number of transition-region barcodes.
                 num = min(num_transition_barcodes,
@@ -215,7 +271,7 @@ class Dataset:
                 # Use the cell barcodes and transition barcodes for analysis.
                 self.analyzed_barcode_inds = np.concatenate((
                     cell_barcodes,
-                    transition_barcodes)).astype(dtype=int)
+                    transition_barcodes)).astype(dtype=np.int32)
 
                 # Identify probable empty droplet barcodes.
                 if num < num_transition_barcodes:
@@ -238,7 +294,8 @@ class Dataset:
                     empty_droplet_barcodes = \
                         umi_count_order[empty_droplet_sorted_barcode_inds]
 
-                self.empty_barcode_inds = empty_droplet_barcodes.astype(dtype=int)
+                self.empty_barcode_inds = \
+                    empty_droplet_barcodes.astype(dtype=np.int32)
 
                 logging.info(f"Using {cell_barcodes.size} probable cell barcodes, "
                              f"plus an additional {transition_barcodes.size} barcodes, "
@@ -254,8 +311,8 @@ class Dataset:
 
         # Estimate the log UMI count turning point between cells and 'empties'.
         self.priors['log_counts_crossover'] = \
-            np.mean(np.log1p([self.priors['cell_counts'],
-                              self.priors['empty_counts']])).item()
+            0.5 * (math.log1p(self.priors['cell_counts'])
+                   + math.log1p(self.priors['empty_counts']))
 
         # Estimate prior for the scale param of LogNormal for d.
         if self.model_name != "simple":
@@ -287,18 +344,27 @@ class Dataset:
             self.priors['chi_ambient'], self.priors['chi_bar'] = \
                 estimate_chi_from_dataset(self)
 
+        # The analyzed-gene matrix of all barcodes is no longer needed.
+        self._analyzed_matrix_cache = None
+
     def get_count_matrix(self) -> sp.csr.csr_matrix:
         """Get the count matrix, trimmed if trimming has occurred."""
 
         if self.is_trimmed:
 
-            # Return the count matrix for selected barcodes and genes.
-            trimmed_bc_matrix = self.data['matrix'][self.analyzed_barcode_inds,
-                                                    :].tocsc()
-            trimmed_matrix = trimmed_bc_matrix[:, self.analyzed_gene_inds].tocsr()
+            # Slice and transform only once, then re-use the result.
+            if self._trimmed_matrix_cache is None:
 
-            # Apply transformation to the count data.
-            return self.transformation.transform(trimmed_matrix)
+                # Return the count matrix for selected barcodes and genes.
+                trimmed_matrix = _csr_submatrix(self.data['matrix'],
+                                                rows=self.analyzed_barcode_inds,
+                                                cols=self.analyzed_gene_inds)
+
+                # Apply transformation to the count data.
+                self._trimmed_matrix_cache = \
+                    self.transformation.transform(trimmed_matrix)
+
+            return self._trimmed_matrix_cache
 
         else:
             logging.warning("Using full count matrix, without any trimming.  "
@@ -312,13 +378,19 @@ class Dataset:
 
         if self.is_trimmed:
 
-            # Return the count matrix for selected barcodes and genes.
-            trimmed_bc_matrix = self.data['matrix'][self.empty_barcode_inds,
-                                                    :].tocsc()
-            trimmed_matrix = trimmed_bc_matrix[:, self.analyzed_gene_inds].tocsr()
+            # Slice and transform only once, then re-use the result.
+            if self._trimmed_empties_cache is None:
 
-            # Apply transformation to the count data.
-            return self.transformation.transform(trimmed_matrix)
+                # Return the count matrix for selected barcodes and genes.
+                trimmed_matrix = _csr_submatrix(self.data['matrix'],
+                                                rows=self.empty_barcode_inds,
+                                                cols=self.analyzed_gene_inds)
+
+                # Apply transformation to the count data.
+                self._trimmed_empties_cache = \
+                    self.transformation.transform(trimmed_matrix)
+
+            return self._trimmed_empties_cache
 
         else:
             logging.error("Trying to get empty count matrix without trimmed data.")
@@ -331,9 +403,8 @@ class Dataset:
 
         if self.is_trimmed:
 
-            # Return the count matrix for selected barcodes and genes.
-            trimmed_bc_matrix = self.data['matrix'].tocsc()
-            trimmed_matrix = trimmed_bc_matrix[:, self.analyzed_gene_inds].tocsr()
+            # Return the count matrix for all barcodes and selected genes.
+            trimmed_matrix = self._get_analyzed_matrix()
 
             # Apply transformation to the count data.
             return self.transformation.transform(trimmed_matrix)
@@ -393,7 +464,7 @@ class Dataset:
         else:
 
             # No need to generate a new count matrix for simple model.
-            inferred_count_matrix = self.data['matrix'].tocsc()
+            inferred_count_matrix = self.data['matrix']
             logging.info("Simple model: outputting un-altered count matrix.")
 
         # TODO: add back in blacklisted genes: their original counts
@@ -403,7 +474,11 @@ class Dataset:
             get_ambient_expression()
 
         # Convert the indices from trimmed gene set to original gene indices.
-        ambient_expression = np.zeros(self.data['matrix'].shape[1])
+        # (Keep the model's precision, rather than promoting to float64.)
+        n_genes = self.data['matrix'].shape[1]
+        dtype = (ambient_expression_trimmed.dtype
+                 if ambient_expression_trimmed is not None else float)
+        ambient_expression = np.zeros(n_genes, dtype=dtype)
         ambient_expression[self.analyzed_gene_inds] = ambient_expression_trimmed
 
         # Inferred contamination fraction hyperparameters.
@@ -416,8 +491,8 @@ class Dataset:
         if p is not None:
             p[np.isnan(p)] = 0.
             cell_barcode_inds = self.analyzed_barcode_inds
-            assert np.sum(p > 0.5) > 0, "Found no cells."
-            filtered_inds_of_analyzed_barcodes = p > 0.5
+            filtered_inds_of_analyzed_barcodes = np.flatnonzero(p > 0.5)
+            assert filtered_inds_of_analyzed_barcodes.size > 0, "Found no cells."
         else:
             cell_barcode_inds = self.analyzed_barcode_inds
             filtered_inds_of_analyzed_barcodes = np.arange(0, d.size)
@@ -426,6 +501,9 @@ class Dataset:
         inferred_count_matrix = \
             self.transformation.inverse_transform(inferred_count_matrix)
 
+        # Keep the count matrix in CSR format, for fast selection of barcodes.
+        inferred_count_matrix = inferred_count_matrix.tocsr()
+
         # Write to output file.
         write_succeeded = write_matrix_to_h5(output_file=output_file,
                                              gene_names=self.data['gene_names'],
@@ -468,11 +546,10 @@ class Dataset:
 
             # Save barcodes determined to contain cells as _cell_barcodes.csv
             try:
-                barcode_names = np.array([str(cell_barcodes[i], encoding='UTF-8')
-                                         for i in range(cell_barcodes.size)])
+                barcode_names = np.char.decode(np.asarray(cell_barcodes), 'UTF-8')
             except UnicodeDecodeError:
                 barcode_names = cell_barcodes  # necessary if barcodes are ints
-            except TypeError:
+            except (TypeError, AttributeError):
                 barcode_names = cell_barcodes  # necessary if barcodes are already decoded
             bc_file_name = os.path.join(file_dir, file_name + "_cell_barcodes.csv")
             np.savetxt(bc_file_name, barcode_names, delimiter=',', fmt='%s')
@@ -481,6 +558,13 @@ class Dataset:
         try:
             # Save plots, if called for.
             if save_plots:
+
+                # Plotting libraries are only imported when plots are made.
+                from sklearn.decomposition import PCA
+                import matplotlib
+                matplotlib.use('Agg')
+                import matplotlib.pyplot as plt  # This needs to be after matplotlib.use('Agg')
+
                 plt.figure(figsize=(6, 18))
 
                 # Plot the train and test error.
@@ -502,7 +586,7 @@ class Dataset:
                 # Plot the barcodes used, along with the inferred cell probabilities.
                 plt.subplot(3, 1, 2)
                 count_mat = self.get_count_matrix()
-                counts = np.array(count_mat.sum(axis=1)).squeeze()
+                counts = count_mat.sum(axis=1).A1
                 count_order = np.argsort(counts)[::-1]
                 plt.semilogy(counts[count_order], color='black')
                 plt.ylabel('UMI counts')
@@ -518,10 +602,17 @@ class Dataset:
 
                 # Plot the latent encoding via PCA.
                 plt.subplot(3, 1, 3)
-                pca = PCA(n_components=2)
+                pca = PCA(n_components=2, svd_solver='randomized',
+                          random_state=0)
                 if p is None:
                     p = np.ones_like(d)
-                z_pca = pca.fit_transform(z[p >= 0.5])
+                z_cells = z[p >= 0.5]
+                if z_cells.shape[0] > 20000:
+                    # A random subset of cells is plenty for a scatter plot.
+                    subset = np.random.RandomState(seed=0).choice(
+                        z_cells.shape[0], size=20000, replace=False)
+                    z_cells = z_cells[subset]
+                z_pca = pca.fit_transform(z_cells)
                 plt.plot(z_pca[:, 0], z_pca[:, 1],
                          '.', ms=3, color='black', alpha=0.3)
                 plt.ylabel('PC 1')
@@ -631,7 +722,7 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
 
     # try:
     with tables.open_file(filename, 'r') as f:
-        # Initialize empty lists.
+        # Initialize empty lists.  Gene names are kept as one array per genome.
         gene_names = []
         csc_list = []
         barcodes = None
@@ -643,17 +734,17 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
             try:
                 # Read in data for this genome, and put it into a
                 # scipy.sparse.csc.csc_matrix
-                barcodes = getattr(group, 'barcodes').read()
-                data = getattr(group, 'data').read()
-                indices = getattr(group, 'indices').read()
-                indptr = getattr(group, 'indptr').read()
-                shape = getattr(group, 'shape').read()
+                barcodes = getattr(group, 'barcodes')[:]
+                data = getattr(group, 'data')[:]
+                indices = getattr(group, 'indices')[:]
+                indptr = getattr(group, 'indptr')[:]
+                shape = getattr(group, 'shape')[:]
                 csc_list.append(sp.csc_matrix((data, indices, indptr),
                                               shape=shape))
                 
                 # Code for v2
                 try:
-                    gene_names.extend(getattr(group, 'gene_names').read())
+                    gene_names.append(getattr(group, 'gene_names')[:])
                     
                 except tables.NoSuchNodeError: 
                     # This exists in case the file is CellRanger v3
@@ -663,16 +754,17 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
                 try:
                     # Read in 'feature' information
                     feature_group = f.get_node(group, 'features')
-                    feature_types = getattr(feature_group, 'feature_type').read()
-                    feature_names = getattr(feature_group, 'name').read()
+                    feature_types = getattr(feature_group, 'feature_type')[:]
+                    feature_names = getattr(feature_group, 'name')[:]
                     
                     # The only 'feature' we want is 'Gene Expression'
                     is_gene_expression = (feature_types == b'Gene Expression')
-                    gene_names.extend(feature_names[is_gene_expression])
+                    gene_names.append(feature_names[is_gene_expression])
                     
                     # Excise other 'features' from the count matrix
-                    gene_feature_inds = np.where(is_gene_expression)[0]
-                    csc_list[-1] = csc_list[-1][gene_feature_inds, :]
+                    if not is_gene_expression.all():
+                        gene_feature_inds = np.where(is_gene_expression)[0]
+                        csc_list[-1] = csc_list[-1][gene_feature_inds, :]
                     
                 except tables.NoSuchNodeError: 
                     # This exists in case the file is CellRanger v2
@@ -682,9 +774,25 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
                 # This exists to bypass the root node, which has no data.
                 pass
 
-    # Put the data from all genomes together (for v2 datasets).
-    count_matrix = sp.vstack(csc_list, format='csc')
-    count_matrix = count_matrix.transpose().tocsr()
+    if len(csc_list) == 1:
+
+        # A single genome: the transpose of a csc_matrix is the csr_matrix
+        # built from the very same arrays, so no data needs to be copied.
+        csc = csc_list[0]
+        count_matrix = sp.csr_matrix((csc.data, csc.indices, csc.indptr),
+                                     shape=csc.shape[::-1])
+
+    else:
+
+        # Put the data from all genomes together (for v2 datasets).
+        count_matrix = sp.vstack(csc_list, format='csc')
+        count_matrix = count_matrix.transpose().tocsr()
+
+    # Put the gene names from all genomes together.
+    if len(gene_names) > 0:
+        gene_names = np.concatenate(gene_names)
+    else:
+        gene_names = np.array([])
 
     # Issue warnings if necessary, based on dimensions matching.
     if count_matrix.shape[1] != len(gene_names):
@@ -695,7 +803,7 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
                         f"the number expected from the count matrix.")
 
     return {'matrix': count_matrix,
-            'gene_names': np.array(gene_names),
+            'gene_names': gene_names,
             'barcodes': np.array(barcodes)}
 
     # In order to batch files, this exception is now caught in command_line.py
@@ -709,7 +817,8 @@ def get_matrix_from_h5(filename: str) -> Dict[str,
 def write_matrix_to_h5(output_file: str,
                        gene_names: np.ndarray,
                        barcodes: np.ndarray,
-                       inferred_count_matrix: sp.csc.csc_matrix,
+                       inferred_count_matrix: Union[sp.csr_matrix,
+                                                    sp.csc_matrix],
                        cell_barcode_inds: Union[np.ndarray, None] = None,
                        ambient_expression: Union[np.ndarray, None] = None,
                        rho: Union[np.ndarray, None] = None,
@@ -725,7 +834,7 @@ def write_matrix_to_h5(output_file: str,
         gene_names: Name of each gene (column of count matrix).
         barcodes: Name of each barcode (row of count matrix).
         inferred_count_matrix: Count matrix to be written to file, in sparse
-            format.  Rows are barcodes, columns are genes.
+            format (csr_matrix preferred).  Rows are barcodes, columns are genes.
         cell_barcode_inds: Indices into the original cell barcode array that
             were found to contain cells.
         ambient_expression: Vector of gene expression of the ambient RNA
@@ -740,12 +849,17 @@ def write_matrix_to_h5(output_file: str,
     Note:
         To match the CellRanger .h5 files, the matrix is stored as its
         transpose, with rows as genes and cell barcodes as columns.
+        The inferred quantities (ambient_expression, rho, phi, z, d, p) are
+        stored as float32, and cell_barcode_inds as int32.  Count values are
+        stored as int32 when they are whole numbers, and float32 otherwise.
+        The indices and indptr arrays are stored as int32 when they fit.
 
     """
 
     assert isinstance(inferred_count_matrix,
-                      sp.csc_matrix), "The count matrix must be csc_matrix " \
-                                      "format in order to write to HDF5."
+                      (sp.csr_matrix, sp.csc_matrix)), \
+        "The count matrix must be csr_matrix or csc_matrix format in order " \
+        "to write to HDF5."
 
     assert gene_names.size == inferred_count_matrix.shape[1], \
         "The number of gene names must match the number of columns in the count" \
@@ -756,7 +870,26 @@ def write_matrix_to_h5(output_file: str,
         "matrix."
 
     # This reverses the role of rows and columns, to match CellRanger format.
-    inferred_count_matrix = inferred_count_matrix.transpose().tocsc()
+    if isinstance(inferred_count_matrix, sp.csr_matrix):
+
+        # The transpose of a csr_matrix is the csc_matrix built from the very
+        # same arrays, so no data needs to be copied.
+        inferred_count_matrix = \
+            sp.csc_matrix((inferred_count_matrix.data,
+                           inferred_count_matrix.indices,
+                           inferred_count_matrix.indptr),
+                          shape=inferred_count_matrix.shape[::-1])
+
+    else:
+        inferred_count_matrix = inferred_count_matrix.transpose().tocsc()
+
+    # Index arrays are stored as int32 whenever the values fit.
+    indices = inferred_count_matrix.indices
+    indptr = inferred_count_matrix.indptr
+    if inferred_count_matrix.shape[0] < 2**31:
+        indices = indices.astype(np.int32, copy=False)
+    if inferred_count_matrix.nnz < 2**31:
+        indptr = indptr.astype(np.int32, copy=False)
 
     # Write to output file.
     try:
@@ -768,48 +901,128 @@ def write_matrix_to_h5(output_file: str,
                                    "Counts after background correction")
 
             # Create arrays within that group for barcodes and gene_names.
-            f.create_array(group, "gene_names", gene_names)
-            f.create_array(group, "genes", np.arange(gene_names.size))  # For compatibility, added post PR
-            f.create_array(group, "barcodes", barcodes)
+            _create_compressed_array(f, group, "gene_names", gene_names)
+            _create_compressed_array(f, group, "genes", np.arange(gene_names.size))  # For compatibility, added post PR
+            _create_compressed_array(f, group, "barcodes", barcodes)
 
             # Create arrays to store the count data.
-            f.create_array(group, "data", inferred_count_matrix.data)
-            f.create_array(group, "indices", inferred_count_matrix.indices)
-            f.create_array(group, "indptr", inferred_count_matrix.indptr)
+            _create_compressed_array(f, group, "data",
+                                     _compact_count_data(inferred_count_matrix.data))
+            _create_compressed_array(f, group, "indices", indices)
+            _create_compressed_array(f, group, "indptr", indptr)
             f.create_array(group, "shape", inferred_count_matrix.shape)
 
             # Store background gene expression, barcode_inds, z, d, and p.
+            # (Inferred quantities are stored in single precision.)
             if cell_barcode_inds is not None:
                 f.create_array(group, "barcode_indices_for_latents",
-                               cell_barcode_inds)
+                               np.asarray(cell_barcode_inds, dtype=np.int32))
             if ambient_expression is not None:
-                f.create_array(group, "ambient_expression", ambient_expression)
+                f.create_array(group, "ambient_expression",
+                               np.asarray(ambient_expression, dtype=np.float32))
             if z is not None:
-                f.create_array(group, "latent_gene_encoding", z)
+                _create_compressed_array(f, group, "latent_gene_encoding",
+                                         np.asarray(z, dtype=np.float32))
             if d is not None:
-                f.create_array(group, "latent_scale", d)
+                _create_compressed_array(f, group, "latent_scale",
+                                         np.asarray(d, dtype=np.float32))
             if p is not None:
-                f.create_array(group, "latent_cell_probability", p)
+                _create_compressed_array(f, group, "latent_cell_probability",
+                                         np.asarray(p, dtype=np.float32))
             if rho is not None:
-                f.create_array(group, "contamination_fraction_params", rho)
+                f.create_array(group, "contamination_fraction_params",
+                               np.asarray(rho, dtype=np.float32))
             if phi is not None:
-                f.create_array(group, "overdispersion_params", phi)
+                f.create_array(group, "overdispersion_params",
+                               np.asarray(phi, dtype=np.float32))
             if loss is not None:
+                elbo = loss['train']['elbo']
                 f.create_array(group, "training_elbo_per_epoch",
-                               np.array(loss['train']['elbo']))
+                               np.fromiter(elbo, dtype=float, count=len(elbo)))
 
         logging.info(f"Succeeded in writing output to file {output_file}")
 
         return True
 
-    except Exception:
+    # File-system and HDF5 errors (tables.HDF5ExtError is a RuntimeError),
+    # and arrays that cannot be converted for storage.
+    except (OSError, RuntimeError, ValueError, TypeError) as e:
         logging.warning(f"Encountered an error writing output to file "
-                        f"{output_file}.  "
+                        f"{output_file} ({e}).  "
                         "Output may be incomplete.")
 
         return False
 
 
+def _compact_count_data(data: np.ndarray) -> np.ndarray:
+    """Cast count values to int32 if they are whole numbers, else float32.
+
+    Inferred counts may arrive as 64-bit integers or (after an inverse
+    transformation) as float64.  Storing them in 32 bits halves the bytes
+    written and read back.
+
+    Args:
+        data: Stored values of a sparse count matrix.
+
+    Returns:
+        data: The same values as int32 when they are integers that fit, and
+            otherwise as float32.
+
+    """
+
+    if data.size == 0:
+        return data.astype(np.int32)
+
+    fits_int32 = (data.min() >= -2**31) and (data.max() < 2**31)
+
+    if np.issubdtype(data.dtype, np.integer):
+        return data.astype(np.int32, copy=False) if fits_int32 else data
+
+    if fits_int32:
+        int_data = data.astype(np.int32)
+        if np.array_equal(int_data, data):
+            return int_data
+
+    return data.astype(np.float32, copy=False)
+
+
+def _create_compressed_array(f: tables.File,
+                             group: tables.Group,
+                             name: str,
+                             array: np.ndarray) -> tables.Array:
+    """Store an array in an HDF5 file as a chunked, compressed CArray.
+
+    Uses gzip (zlib) compression with the byte-shuffle filter, which works well
+    on UMI count data and can be read by any HDF5 library, including h5py, so
+    output files stay readable by tools that expect the CellRanger format.
+
+    Args:
+        f: Open pytables file.
+        group: Group in which to create the array.
+        name: Name of the array node.
+        array: Data to be written.
+
+    Returns:
+        The created pytables array node.
+
+    """
+
+    array = np.asarray(array)
+
+    # HDF5 chunks cannot be empty.
+    if array.size == 0:
+        return f.create_array(group, name, array)
+
+    # Chunks of about a megabyte along the first axis for vectors.
+    chunkshape = None  # Let pytables choose for higher dimensional arrays.
+    if array.ndim == 1:
+        chunkshape = (min(array.size, max(1, 2**20 // array.itemsize)),)
+
+    return f.create_carray(group, name, obj=array, chunkshape=chunkshape,
+                           filters=tables.Filters(complevel=4, complib='zlib',
+                                                  shuffle=True))
+
+
 def get_d_priors_from_dataset(dataset: Dataset) -> Tuple[float, float]:
     """Compute an estimate of reasonable priors on cell size and ambient size.
 
@@ -833,25 +1046,25 @@ def get_d_priors_from_dataset(dataset: Dataset) -> Tuple[float, float]:
 
     """
 
+    # Select the analyzed genes only once.
+    analyzed_matrix = dataset._get_analyzed_matrix()
+
     # Count the total unique UMIs per barcode (summing after transforming).
     transformed_counts = \
-        np.array(dataset.transformation.transform(dataset.data['matrix']
-                                                  [:, dataset.analyzed_gene_inds])
-                 .sum(axis=1)).squeeze()
-    counts = np.array(dataset.data['matrix']
-                      [:, dataset.analyzed_gene_inds].sum(axis=1)).squeeze()
+        _csr_row_sums(dataset.transformation.transform(analyzed_matrix))
+    counts = _csr_row_sums(analyzed_matrix)
 
     # If it's a model that does not model empty droplets, the dataset is cells.
     if dataset.model_name == 'simple':
 
         assert type(dataset.priors['n_cells']) is int, "No prior on number of cells."
 
-        # Sort order the cells by counts.
-        sort_order = np.argsort(counts)[::-1]
+        # Find the cells with the largest counts (their order does not matter).
+        n = min(dataset.priors['n_cells'], counts.size)
+        top_cells = np.argpartition(counts, counts.size - n)[counts.size - n:]
 
         # Estimate cell count by median, taking 'cells' to be the largest counts.
-        cell_counts = int(np.median(transformed_counts[sort_order]
-                                    [:dataset.priors['n_cells']]).item())
+        cell_counts = int(np.median(transformed_counts[top_cells]).item())
 
         empty_counts = 0
 
@@ -864,8 +1077,11 @@ def get_d_priors_from_dataset(dataset: Dataset) -> Tuple[float, float]:
         # Estimate the number of UMI counts in empty droplets.
 
         # Mode of (rounded) log counts (for counts > cut) is a robust empty estimator.
-        empty_log_counts = mode(np.round(np.log1p(transformed_counts[counts > cut]),
-                                         decimals=1))[0]
+        # Log counts rounded to one decimal are binned as integers in tenths.
+        log_count_tenths = np.log1p(transformed_counts[counts > cut])
+        log_count_tenths *= 10
+        np.rint(log_count_tenths, out=log_count_tenths)
+        empty_log_counts = np.bincount(log_count_tenths.astype(np.intp)).argmax() / 10
         empty_counts = int(np.expm1(empty_log_counts).item())
 
         # Estimate the number of UMI counts in cells.
@@ -909,18 +1125,16 @@ def estimate_cell_count_from_dataset(dataset: Dataset) -> int:
         return dataset.data['matrix'].shape[0]
 
     # Count number of UMIs in each barcode.
-    counts = np.array(dataset.data['matrix'].sum(axis=1),
-                      dtype=int).squeeze()
-
-    # Find the order that sorts barcodes by UMI count.
-    count_sort_order = np.argsort(counts)[::-1]  # Decreasing UMI counts
+    counts = np.asarray(dataset._get_umi_counts(), dtype=int)
 
     # Find the UMI count cutoff as 0.9 * counts(99th percentile barcode)
+    # (a partial sort suffices to find the barcode at that rank).
     ninety_ninth_percentile_ind = int(counts.size * 0.01)
-    umi_cutoff = 0.9 * counts[count_sort_order][ninety_ninth_percentile_ind]
+    rank_from_bottom = counts.size - 1 - ninety_ninth_percentile_ind
+    umi_cutoff = 0.9 * np.partition(counts, rank_from_bottom)[rank_from_bottom]
 
     # Count the number of barcodes with UMI counts above the cutoff.
-    cell_count_est = int(np.sum(counts > umi_cutoff).item())
+    cell_count_est = np.count_nonzero(counts > umi_cutoff)
 
     return cell_count_est
 
@@ -958,26 +1172,156 @@ def estimate_chi_from_dataset(dataset: Dataset) -> Tuple[torch.Tensor,
     count_matrix = dataset.get_count_matrix()
 
     # Empty droplets have log counts < log_crossover.
-    empty_barcodes = (np.log(np.array(count_matrix.sum(axis=1)).squeeze())
-                      < log_crossover)
+    empty_barcodes = np.log(_csr_row_sums(count_matrix)) < log_crossover
 
-    # Sum gene expression for the empty droplets.
-    gene_expression = np.array(count_matrix[empty_barcodes, :].sum(axis=0)).squeeze()
+    # Sum gene expression for the empty droplets, as a single sparse
+    # matrix-vector product, without extracting their rows.
+    gene_expression = count_matrix.transpose().dot(empty_barcodes.astype(float))
 
-    # As a vector on a simplex.
-    gene_expression = gene_expression + ep
-    chi_ambient_init = \
-        torch.Tensor(gene_expression / np.sum(gene_expression))
+    # As a vector on a simplex (normalized in place).
+    gene_expression += ep
+    gene_expression /= gene_expression.sum()
+    chi_ambient_init = torch.as_tensor(gene_expression, dtype=torch.float32)
 
     # Full count matrix, appropriately transformed.
     full_count_matrix = dataset.get_count_matrix_all_barcodes()
 
     # Sum all gene expression.
-    gene_expression_total = np.array(full_count_matrix.sum(axis=0)).squeeze()
+    gene_expression_total = \
+        full_count_matrix.sum(axis=0).A1.astype(float, copy=False)
 
-    # As a vector on a simplex.
-    gene_expression_total = gene_expression_total + ep
-    chi_bar = \
-        torch.Tensor(gene_expression_total / np.sum(gene_expression_total))
+    # As a vector on a simplex (normalized in place).
+    gene_expression_total += ep
+    gene_expression_total /= gene_expression_total.sum()
+    chi_bar = torch.as_tensor(gene_expression_total, dtype=torch.float32)
 
     return chi_ambient_init, chi_bar
+
+
+def _sum_dtype(dtype: np.dtype) -> np.dtype:
+    """Accumulator dtype for sums, upcasting integers as scipy.sparse does."""
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        return np.dtype(np.uint64)
+    if dtype.kind in 'ib':
+        return np.dtype(np.int64)
+    return dtype
+
+
+def _csr_row_sums(matrix: Union[sp.csr_matrix, sp.csc_matrix]) -> np.ndarray:
+    """Sum each row of a sparse matrix, as a 1D array.
+
+    Equivalent to np.array(matrix.sum(axis=1)).squeeze(), but computed with a
+    single pass over the stored values using np.add.reduceat on the CSR
+    index pointer, without the intermediate np.matrix.
+
+    Args:
+        matrix: Sparse matrix, preferably scipy.sparse.csr_matrix.
+
+    Returns:
+        row_sums: 1D numpy array of length matrix.shape[0].
+
+    """
+
+    # The transpose of a csc_matrix is a csr_matrix view of the same arrays.
+    if sp.isspmatrix_csc(matrix):
+        return _csr_col_sums(matrix.transpose())
+    matrix = sp.csr_matrix(matrix)  # No copy if already csr_matrix.
+
+    row_sums = np.zeros(matrix.shape[0], dtype=_sum_dtype(matrix.dtype))
+
+    # Reduce only over non-empty rows: reduceat would not give zero otherwise.
+    nonempty = np.diff(matrix.indptr) > 0
+    if nonempty.any():
+        row_sums[nonempty] = np.add.reduceat(matrix.data,
+                                             matrix.indptr[:-1][nonempty],
+                                             dtype=row_sums.dtype)
+
+    return row_sums
+
+
+def _csr_col_sums(matrix: Union[sp.csr_matrix, sp.csc_matrix]) -> np.ndarray:
+    """Sum each column of a sparse matrix, as a 1D array.
+
+    Args:
+        matrix: Sparse matrix.
+
+    Returns:
+        col_sums: 1D numpy array of length matrix.shape[1].
+
+    """
+
+    # The transpose of a csc_matrix is a csr_matrix view of the same arrays.
+    if sp.isspmatrix_csc(matrix):
+        return _csr_row_sums(matrix.transpose())
+
+    # scipy's column sum accumulates the stored values in their own dtype,
+    # which is faster and leaner than a weighted (float64) np.bincount.
+    return np.asarray(matrix.sum(axis=0)).ravel()
+
+
+def _top_k_order(values: np.ndarray, k: int) -> np.ndarray:
+    """Get the indices of the k largest values, in decreasing order of value.
+
+    This is equivalent to np.argsort(values)[::-1][:k], but uses a partial
+    sort (np.argpartition), so that only the k selected entries are sorted.
+
+    Args:
+        values: 1D array of values, e.g. UMI counts per barcode.
+        k: Number of top entries to return.
+
+    Returns:
+        order: Indices of the k largest elements of values, largest first.
+
+    """
+
+    k = max(0, min(int(k), values.size))
+
+    # Full sort when (nearly) everything is needed anyway.
+    if k >= values.size - 1:
+        return np.argsort(values)[::-1][:k]
+
+    if k == 0:
+        return np.array([], dtype=np.intp)
+
+    # Partition ascending: negating the values would wrap unsigned counts.
+    top_k = np.argpartition(values, values.size - k)[values.size - k:]
+    return top_k[np.argsort(values[top_k])[::-1]]
+
+
+def _csr_submatrix(matrix: Union[sp.csr_matrix, sp.csc_matrix],
+                   rows: Union[np.ndarray, slice],
+                   cols: Union[np.ndarray, None] = None) -> sp.csr_matrix:
+    """Extract the submatrix matrix[rows, :][:, cols] in CSR format.
+
+    Rows are selected first, since CSR row indexing is cheap and usually
+    shrinks the matrix a lot, and then scipy's CSR column indexing picks the
+    columns.  Selecting all rows does not copy the matrix.
+
+    Args:
+        matrix: Sparse count matrix, with barcodes as rows and genes as columns.
+        rows: Indices (or a slice) of the rows to keep.
+        cols: Indices of the columns to keep, in the desired order.
+            None keeps all columns.
+
+    Returns:
+        submatrix: scipy.sparse.csr_matrix of shape (len(rows), len(cols)).
+
+    """
+
+    matrix = sp.csr_matrix(matrix)  # No copy if already csr_matrix.
+
+    # Select rows.
+    if not isinstance(rows, slice):
+        rows = np.asarray(rows)
+        if not np.issubdtype(rows.dtype, np.integer):
+            rows = rows.astype(int)  # e.g. an empty float array
+        matrix = matrix[rows]
+    elif rows != slice(None):
+        matrix = matrix[rows]
+
+    # Select columns.
+    if cols is not None:
+        matrix = matrix[:, np.asarray(cols)]
+
+    return matrix
@@ -1,6 +1,7 @@
 import unittest
 from unittest import main as unittest_main
 import os
+import tempfile
 import warnings
 
 import cellbender
@@ -9,8 +10,10 @@ from cellbender.remove_background.train import run_inference
 from cellbender.remove_background.data.simulate import simulate_ambient_dataset
 import cellbender.remove_background.data.transform as transform
 from cellbender.remove_background.data.dataset import Dataset, \
-    write_matrix_to_h5, get_matrix_from_h5
+    write_matrix_to_h5, get_matrix_from_h5, _csr_submatrix, _top_k_order, \
+    _csr_row_sums, _csr_col_sums, _compact_count_data
 import numpy as np
+import scipy.sparse as sp
 import sys
 
 
@@ -154,6 +157,137 @@ class TestConsole(unittest.TestCase):
 
             return 0
 
+    def test_csr_submatrix(self):
+        """Check that CSR submatrix extraction matches scipy fancy indexing."""
+
+        dense = np.random.RandomState(0).poisson(0.3, size=(40, 30))
+        dense[5, :] = 0  # An empty row.
+        matrix = sp.csr_matrix(dense)
+
+        cols = np.array([7, 2, 29, 0, 13])  # Unsorted.
+        for rows in [np.array([5, 3, 0, 39]), np.arange(40), slice(2, 9)]:
+            expected = matrix[rows][:, cols]
+            submatrix = _csr_submatrix(matrix, rows=rows, cols=cols)
+            self.assertIsInstance(submatrix, sp.csr_matrix)
+            self.assertEqual(submatrix.shape, expected.shape)
+            np.testing.assert_array_equal(submatrix.toarray(),
+                                          expected.toarray())
+
+        # All rows, and no column selection.
+        np.testing.assert_array_equal(
+            _csr_submatrix(matrix, rows=slice(None)).toarray(), dense)
+
+        # No rows at all, given as an empty (float) array.
+        self.assertEqual(_csr_submatrix(matrix, rows=np.array([]),
+                                        cols=cols).shape, (0, cols.size))
+
+    def test_top_k_order(self):
+        """Check that the partial top-k ordering matches a full argsort."""
+
+        random_state = np.random.RandomState(0)
+        ks = [0, 1, 2, 10, 999, 1000, 2000]
+
+        # Without ties, the order is fully determined.
+        values = random_state.permutation(1000)
+        for k in ks:
+            np.testing.assert_array_equal(_top_k_order(values, k),
+                                          np.argsort(values)[::-1][:k])
+
+        # Unsigned UMI counts with many zeros and ties: the selected values
+        # must match, in order, even if tied barcodes are picked differently.
+        for dtype in [np.uint32, np.uint64, np.int64]:
+            values = (random_state.poisson(0.5, size=1000)
+                      * random_state.randint(0, 20, size=1000)).astype(dtype)
+            for k in ks:
+                np.testing.assert_array_equal(
+                    values[_top_k_order(values, k)],
+                    values[np.argsort(values)[::-1][:k]])
+
+        np.testing.assert_array_equal(
+            _top_k_order(np.array([0, 6, 0, 100, 2], dtype=np.uint64), 2),
+            [3, 1])
+
+    def test_csr_row_and_col_sums(self):
+        """Check sparse row and column sums, including empty rows."""
+
+        dense = np.random.RandomState(0).poisson(0.3, size=(40, 30))
+        dense[[0, 5, 39], :] = 0  # Empty rows, including first and last.
+        for dtype in [np.uint32, np.int64, np.float32]:
+            for matrix in [sp.csr_matrix(dense.astype(dtype)),
+                           sp.csc_matrix(dense.astype(dtype))]:
+                row_sums = _csr_row_sums(matrix)
+                col_sums = _csr_col_sums(matrix)
+                expected_rows = np.asarray(matrix.sum(axis=1)).ravel()
+                expected_cols = np.asarray(matrix.sum(axis=0)).ravel()
+                self.assertEqual(row_sums.dtype, expected_rows.dtype)
+                self.assertEqual(col_sums.dtype, expected_cols.dtype)
+                np.testing.assert_array_equal(row_sums, expected_rows)
+                np.testing.assert_array_equal(col_sums, expected_cols)
+
+    def test_compact_count_data(self):
+        """Check the dtype chosen for stored count values."""
+
+        cases = [(np.array([1, 2, 3], dtype=np.int64), np.int32),
+                 (np.array([1, 2, 3], dtype=np.uint32), np.int32),
+                 (np.array([1., 2., 3.]), np.int32),
+                 (np.array([1.5, 2.]), np.float32),
+                 (np.array([2**40], dtype=np.int64), np.int64),
+                 (np.array([1e12]), np.float32),
+                 (np.array([]), np.int32)]
+        for data, dtype in cases:
+            compact = _compact_count_data(data)
+            self.assertEqual(compact.dtype, dtype)
+            np.testing.assert_allclose(compact, data, rtol=1e-6)
+
+    def test_write_and_read_csr(self):
+        """Check a CSR count matrix round trip through an HDF5 file."""
+
+        dense = np.random.RandomState(0).poisson(0.3, size=(40, 30))
+        dense[5, :] = 0  # An empty barcode.
+        matrix = sp.csr_matrix(dense)
+        gene_names = np.array([f'g_{i}' for i in range(matrix.shape[1])])
+        barcodes = np.array([f'bc_{i}' for i in range(matrix.shape[0])])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, 'testfile.h5')
+            self.assertTrue(
+                write_matrix_to_h5(file_name,
+                                   gene_names=gene_names,
+                                   barcodes=barcodes,
+                                   inferred_count_matrix=matrix,
+                                   ambient_expression=np.ones(30) / 30))
+            reconstructed = get_matrix_from_h5(file_name)
+
+        self.assertIsInstance(reconstructed['matrix'], sp.csr_matrix)
+        np.testing.assert_array_equal(reconstructed['matrix'].toarray(), dense)
+        np.testing.assert_array_equal(reconstructed['gene_names'].astype(str),
+                                      gene_names)
+        np.testing.assert_array_equal(reconstructed['barcodes'].astype(str),
+                                      barcodes)
+
+    def test_trim_keeps_cells_with_unsigned_counts(self):
+        """Check that trimming keeps the cells of an unsigned count matrix."""
+
+        random_state = np.random.RandomState(0)
+        n_cells = 100
+        dense = np.vstack([random_state.poisson(10, size=(n_cells, 100)),
+                           random_state.poisson(0.5, size=(1000, 100)),
+                           np.zeros((200, 100), dtype=int)])  # Zero barcodes.
+
+        for model_name in ['full', 'simple']:
+            dataset_obj = Dataset(transformation=transform.IdentityTransform(),
+                                  model_name=model_name)
+            dataset_obj.data = \
+                {'matrix': sp.csr_matrix(dense.astype(np.uint32)),
+                 'gene_names': np.array([f'g{n}' for n in range(100)]),
+                 'barcodes': np.array([f'bc{n}' for n in range(dense.shape[0])])}
+            dataset_obj.priors['n_cells'] = n_cells
+            dataset_obj._trim_dataset_for_analysis(num_transition_barcodes=50)
+            dataset_obj._estimate_priors()
+
+            self.assertTrue(np.isin(np.arange(n_cells),
+                                    dataset_obj.analyzed_barcode_inds).all())
+
 
 class ObjectWithAttributes(object):
     """Exists only to populate the args data structure with attributes."""